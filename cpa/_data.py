@@ -1,4 +1,7 @@
-from typing import Optional
+from typing import Optional, List
+
+import torch
+from torch.utils.data.dataloader import default_convert
 
 from scvi import settings
 from scvi.data import AnnDataManager
@@ -6,6 +9,25 @@ from scvi.dataloaders import DataSplitter, AnnDataLoader
 from scvi.model._utils import parse_use_gpu_arg
 
 
+def collate_cat_covars(batch, cat_covars_keys: List[str], cont_covars_keys: Optional[List[str]] = None):
+    """
+    Converts a batch to tensors, with the categorical covariates cast once to int64 tensors of
+    shape (batch_size,) instead of float tensors of shape (batch_size, 1).
+    The covariates are also stacked into `cat_covars` (batch_size, n_cat_covars) and `cont_covars`
+    (batch_size, n_cont_covars), as expected by `CPAModule.inference`, so that they are pinned along
+    with the rest of the batch by a DataLoader with `pin_memory=True`.
+    Use through `functools.partial` to bind `cat_covars_keys` and `cont_covars_keys`.
+    """
+    batch = default_convert(batch)
+    for covar in cat_covars_keys:
+        batch[covar] = batch[covar].long().view(-1, )
+    if len(cat_covars_keys) > 0:
+        batch['cat_covars'] = torch.stack([batch[covar] for covar in cat_covars_keys], dim=1)
+    if cont_covars_keys:
+        batch['cont_covars'] = torch.stack([batch[covar].view(-1, ) for covar in cont_covars_keys], dim=1)
+    return batch
+
+
 class AnnDataSplitter(DataSplitter):
     def __init__(
             self,
@@ -1,6 +1,7 @@
 import json
 import logging
 import os
+from functools import partial
 from typing import Optional, Sequence, Union, List, Dict
 
 import numpy as np
@@ -28,7 +29,7 @@ from tqdm import tqdm
 from ._module import CPAModule
 from ._utils import CPA_REGISTRY_KEYS
 from ._task import CPATrainingPlan
-from ._data import AnnDataSplitter
+from ._data import AnnDataSplitter, collate_cat_covars
 
 logger = logging.getLogger(__name__)
 logger.propagate = False
@@ -136,6 +137,13 @@ class CPA(BaseModelClass):
 
         self.epoch_history = None
 
+    @property
+    def _collate_fn(self):
+        """Collate function of all the data loaders, see `collate_cat_covars`"""
+        return partial(collate_cat_covars,
+                       cat_covars_keys=list(self.cat_covars_encoders.keys()),
+                       cont_covars_keys=self.module.cont_covars)
+
     @classmethod
     @setup_anndata_dsp.dedent
     def setup_anndata(
@@ -314,6 +322,7 @@ class CPA(BaseModelClass):
                 test_indices=self.test_indices,
                 batch_size=batch_size,
                 use_gpu=use_gpu,
+                collate_fn=self._collate_fn,
             )
         else:
             data_splitter = DataSplitter(
@@ -322,6 +331,7 @@ class CPA(BaseModelClass):
                 validation_size=validation_size,
                 batch_size=batch_size,
                 use_gpu=use_gpu,
+                collate_fn=self._collate_fn,
             )
 
         self.training_plan = CPATrainingPlan(
@@ -399,23 +409,30 @@ class CPA(BaseModelClass):
         if indices is None:
             indices = np.arange(adata.n_obs)
         scdl = self._make_data_loader(
-            adata=adata, indices=indices, batch_size=batch_size, shuffle=False
+            adata=adata,
+            indices=indices,
+            batch_size=batch_size,
+            shuffle=False,
+            pin_memory=self.module.device.type == "cuda",
+            collate_fn=self._collate_fn,
         )
 
+        # The outputs stay on the device until the end of the loop, so that the (pinned) inputs of
+        # the next batch are copied while the previous one is still being processed
         latent_basal = []
         latent = []
         for tensors in scdl:
             inference_inputs = self.module._get_inference_input(tensors)
-            outputs = self.module.inference(**inference_inputs)
-            latent_basal += [outputs["latent_basal"].cpu().numpy()]
-            latent += [outputs["latent"].cpu().numpy()]
+            outputs = self.module.inference_graphed(**inference_inputs)
+            latent_basal += [outputs["latent_basal"].clone()]
+            latent += [outputs["latent"].clone()]
 
         latent_basal_adata = AnnData(
-            X=np.concatenate(latent_basal, axis=0), obs=adata.obs.copy()
+            X=torch.cat(latent_basal, dim=0).cpu().numpy(), obs=adata.obs.copy()
         )
         latent_basal_adata.obs_names = adata.obs_names
 
-        latent_adata = AnnData(X=np.concatenate(latent, axis=0), obs=adata.obs.copy())
+        latent_adata = AnnData(X=torch.cat(latent, dim=0).cpu().numpy(), obs=adata.obs.copy())
         latent_adata.obs_names = adata.obs_names
 
         return latent_basal_adata, latent_adata
@@ -445,7 +462,11 @@ class CPA(BaseModelClass):
         if indices is None:
             indices = np.arange(adata.n_obs)
         scdl = self._make_data_loader(
-            adata=adata, indices=indices, batch_size=batch_size, shuffle=False
+            adata=adata,
+            indices=indices,
+            batch_size=batch_size,
+            shuffle=False,
+            collate_fn=self._collate_fn,
         )
         mus = []
         stds = []
@@ -516,7 +537,7 @@ class CPA(BaseModelClass):
                 [self.cat_covars_encoders[covariate][covariate_value]]
             ).to(self.device)
         embeddings = (
-            self.module.cat_covars_embeddings[covariate](covar_ids)
+            self.module.get_covar_embeddings(covariate, covar_ids)
             .detach()
             .cpu()
             .numpy()
@@ -1,8 +1,13 @@
+import contextlib
+import functools
+import logging
+
 from sklearn.metrics import r2_score
 
 import torch
 import torch.distributions as db
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.distributions.kl import kl_divergence
 
 from scvi.module.base import BaseModuleClass, auto_move_data
@@ -11,11 +16,56 @@ from scvi.module import Classifier
 from scvi import settings
 
 from ._metrics import entropy_batch_mixing, knn_purity
-from ._utils import DecoderNormal, DrugNetwork, VanillaEncoder, CPA_REGISTRY_KEYS, DecoderNB
+from ._utils import DecoderNormal, DrugNetwork, VanillaEncoder, CPA_REGISTRY_KEYS, DecoderNB, fold_batch_norm
 
 import numpy as np
 from copy import deepcopy
 
+logger = logging.getLogger(__name__)
+
+
+def _to_static(inputs, device):
+    """Allocates fixed-address copies of (possibly nested) tensor inputs on `device`"""
+    if isinstance(inputs, dict):
+        return {key: _to_static(val, device) for key, val in inputs.items()}
+    elif isinstance(inputs, torch.Tensor):
+        return inputs.to(device).clone()
+    return inputs
+
+
+def _copy_static(static_inputs, inputs):
+    """Copies `inputs` in-place into the buffers created by `_to_static`.
+
+    The copies are asynchronous for pinned host tensors (e.g. from a DataLoader with `pin_memory=True`).
+    """
+    if isinstance(static_inputs, dict):
+        for key, val in static_inputs.items():
+            _copy_static(val, inputs[key])
+    elif isinstance(static_inputs, torch.Tensor):
+        static_inputs.copy_(inputs, non_blocking=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _compile(fn, mode):
+    """`torch.compile`d `fn`, kept out of the modules since compiled functions cannot be pickled"""
+    return torch.compile(fn, mode=mode, dynamic=False)
+
+
+@torch.jit.script
+def _gaussian_nll_fused(x, means, variances, eps: float = 1e-6):
+    """Scripted so that it is fused into a single kernel, see `_gaussian_nll`"""
+    # Clamped for stability in the forward pass only, gradients pass straight through the clamp
+    variances = variances + (variances.clamp(min=eps) - variances).detach()
+    return 0.5 * (torch.log(variances) + (x - means).square() / variances).mean()
+
+
+def _gaussian_nll(x, means, variances, eps: float = 1e-6):
+    """Same as `nn.GaussianNLLLoss()`"""
+    # Checked outside of the scripted function, whose exceptions are raised as `torch.jit.Error`
+    if torch.any(variances < 0):
+        raise ValueError("var has negative entry/entries")
+    return _gaussian_nll_fused(x, means, variances, eps)
+
 
 class CPAModule(BaseModuleClass):
     """
@@ -39,8 +89,20 @@ class CPAModule(BaseModuleClass):
         use_batch_norm: bool
         use_layer_norm: bool
         variational: bool
+        use_compile: bool
+            If `True` and CUDA is available, `inference` and `generative` are wrapped with
+                `torch.compile`
+        compile_mode: str
+            `torch.compile` mode used with `use_compile`, e.g. "reduce-overhead" or "max-autotune"
+        use_amp: bool
+            If `True`, the encoder, decoder, drug network and adversaries run under bfloat16 autocast
+                when the module is on a CUDA device (ignored on CPU). Their outputs and all the losses
+                are kept in float32
     """
 
+    # Maximum number of CUDA graphs cached by `inference_graphed`
+    max_inference_graphs = 4
+
     def __init__(self,
                  n_genes: int,
                  n_drugs: int,
@@ -60,6 +122,9 @@ class CPAModule(BaseModuleClass):
                  use_layer_norm: bool = False,
                  dropout_rate: float = 0.0,
                  variational: bool = False,
+                 use_compile: bool = False,
+                 compile_mode: str = "reduce-overhead",
+                 use_amp: bool = False,
                  seed: int = 0,
                  ):
         super().__init__()
@@ -85,10 +150,15 @@ class CPAModule(BaseModuleClass):
         self.use_batch_norm = use_batch_norm
         self.use_layer_norm = use_layer_norm
         self.variational = variational
+        self.use_amp = use_amp
 
         self.cat_covars_encoder = cat_covars_encoder
         self.cont_covars = cont_covars
 
+        # Bound once so that the covariate loops are unrolled into a flat graph by torch.compile
+        self._cat_covars_keys = tuple(self.cat_covars_encoder.keys())
+        self._cat_covars_sizes = tuple(len(unique_covars) for unique_covars in self.cat_covars_encoder.values())
+
         self.control_treatment_idx = None
 
         self.variational = variational
@@ -131,6 +201,9 @@ class CPAModule(BaseModuleClass):
     
             # Decoder components
             self.px_r = torch.nn.Parameter(torch.randn(n_genes))
+            # px_r.exp() cached for inference, see `_get_px_theta`
+            self.register_buffer('_px_theta', None, persistent=False)
+            self._px_theta_key = None
 
         # Decoder components
         if loss_ae in ["gauss", 'mse']:
@@ -184,28 +257,35 @@ class CPAModule(BaseModuleClass):
         )
 
         # 2. Covariates Embedding
-        self.cat_covars_embeddings = nn.ModuleDict(
-            {
-                key: torch.nn.Embedding(len(unique_covars), n_latent)
-                for key, unique_covars in self.cat_covars_encoder.items()
-            }
+        # All categorical covariates share one table, each covariate's indices are shifted by
+        # the number of unique values of the covariates preceding it
+        self.cat_covars_embeddings = nn.EmbeddingBag(sum(self._cat_covars_sizes), n_latent, mode='sum')
+        self.register_buffer(
+            '_cat_covars_offsets',
+            torch.tensor(np.cumsum((0,) + self._cat_covars_sizes[:-1]), dtype=torch.long),
+            persistent=False,
         )
 
-        self.cat_covars_classifiers = nn.ModuleDict(
-            {
-                key: Classifier(n_input=n_latent,
-                                n_labels=len(unique_covars),
-                                n_hidden=self.adversary_width,
-                                n_layers=self.adversary_depth,
-                                use_batch_norm=use_batch_norm,
-                                use_layer_norm=use_layer_norm,
-                                dropout_rate=dropout_rate,
-                                logits=True)
-                if len(unique_covars) > 1 else None
-
-                for key, unique_covars in self.cat_covars_encoder.items()
-            }
-        )
+        # A single adversary with one output head per categorical covariate (with more than one
+        # unique value), the logits are split per covariate in `adversarial_loss`
+        self._cat_covars_adv_keys = tuple(key for key, n_covars in zip(self._cat_covars_keys, self._cat_covars_sizes)
+                                          if n_covars > 1)
+        self._cat_covars_adv_sizes = tuple(n_covars for n_covars in self._cat_covars_sizes if n_covars > 1)
+        # Columns of the adversaries' targets in the stacked covariates, see `_get_inference_input`
+        self._cat_covars_adv_columns = tuple(self._cat_covars_keys.index(key) for key in self._cat_covars_adv_keys)
+        self._cat_covars_no_adv_keys = tuple(key for key in self._cat_covars_keys
+                                             if key not in self._cat_covars_adv_keys)
+        if len(self._cat_covars_adv_keys) > 0:
+            self.cat_covars_classifier = Classifier(n_input=n_latent,
+                                                    n_labels=sum(self._cat_covars_adv_sizes),
+                                                    n_hidden=self.adversary_width,
+                                                    n_layers=self.adversary_depth,
+                                                    use_batch_norm=use_batch_norm,
+                                                    use_layer_norm=use_layer_norm,
+                                                    dropout_rate=dropout_rate,
+                                                    logits=True)
+        else:
+            self.cat_covars_classifier = None
 
         self.cont_covars_embeddings = nn.ModuleDict(
             {
@@ -228,33 +308,58 @@ class CPAModule(BaseModuleClass):
             }
         )
 
-        self.ae_loss_fn = nn.GaussianNLLLoss()
         self.adv_loss_cat_covariates = nn.CrossEntropyLoss()
         self.adv_loss_cont_covariates = nn.MSELoss()
 
         self.adv_loss_drugs = nn.BCEWithLogitsLoss()
+        # Preallocated on the module's device, returned for the covariates without an adversary
+        self.register_buffer('_zero', torch.zeros(()), persistent=False)
+
+        # batch_size -> (graph, static inputs, static outputs), see `inference_graphed`
+        self._inference_graphs = {}
+        # Batch sizes seen once, a graph is only captured for recurring batch sizes
+        self._inference_calls = set()
+        # `self.device` iterates over all parameters, the hot paths read this one, see `_apply`
+        self._cached_device = next(self.parameters()).device
 
+        self.use_compile = use_compile and torch.cuda.is_available()
+        self.compile_mode = compile_mode
+
+    def _autocast(self):
+        """bfloat16 autocast context for the MLP forward passes, a no-op unless `use_amp` on CUDA"""
+        if not self.use_amp or self._cached_device.type != 'cuda':
+            return contextlib.nullcontext()
+        return torch.autocast(device_type='cuda', dtype=torch.bfloat16)
 
     def _get_inference_input(self, tensors):
         x = tensors[CPA_REGISTRY_KEYS.X_KEY]  # batch_size, n_genes
         drugs_doses = tensors['drugs_doses']
 
-        cat_covars_dict = dict()
-        for covar, unique_covars in self.cat_covars_encoder.items():
-            encoded_covars = tensors[covar].view(-1, )  # (batch_size,)
-            cat_covars_dict[covar] = encoded_covars
-
-        cont_covars_dict = dict()
-        for covar in self.cont_covars:
-            encoded_covars = tensors[covar].view(-1, )  # (batch_size,)
-            cont_covars_dict[covar] = encoded_covars
+        if 'cat_covars' in tensors:
+            cat_covars = tensors['cat_covars']  # stacked by `collate_cat_covars`
+        elif len(self._cat_covars_keys) > 0:
+            # No-ops when the covariates are already cast by `collate_cat_covars`
+            cat_covars = torch.stack(
+                [tensors[covar].view(-1, ).long() for covar in self._cat_covars_keys], dim=1
+            )  # (batch_size, n_cat_covars)
+        else:
+            cat_covars = None
+
+        if 'cont_covars' in tensors:
+            cont_covars = tensors['cont_covars']  # stacked by `collate_cat_covars`
+        elif len(self.cont_covars) > 0:
+            cont_covars = torch.stack(
+                [tensors[covar].view(-1, ) for covar in self.cont_covars], dim=1
+            )  # (batch_size, n_cont_covars)
+        else:
+            cont_covars = None
 
         input_dict = dict(
             genes=x,
             drugs=drugs_doses,
             doses=None,
-            cat_covars_dict=cat_covars_dict,
-            cont_covars_dict=cont_covars_dict,
+            cat_covars=cat_covars,
+            cont_covars=cont_covars,
         )
         return input_dict
 
@@ -264,53 +369,74 @@ class CPAModule(BaseModuleClass):
             genes,
             drugs,
             doses,
-            cat_covars_dict,
-            cont_covars_dict,
+            cat_covars,
+            cont_covars,
+    ):
+        if self.use_compile:
+            # The unbound method is compiled, so that it runs on the weights of `self` (e.g. of a copy)
+            return _compile(CPAModule._inference, self.compile_mode)(
+                self, genes, drugs, doses, cat_covars, cont_covars
+            )
+        return self._inference(genes, drugs, doses, cat_covars, cont_covars)
+
+    def _inference(
+            self,
+            genes,
+            drugs,
+            doses,
+            cat_covars,
+            cont_covars,
     ):
         # x_ = torch.log1p(x)
-        batch_size = genes.shape[0]
         x_ = genes
         if self.loss_ae == 'nb':
             x_ = torch.log1p(x_)
 
-        if self.variational:
-            z_means, z_vars, latent_basal = self.encoder(x_)
-            basal_distribution = db.Normal(z_means, z_vars.sqrt())
-        else:
-            basal_distribution = None
-            latent_basal = self.encoder(x_)
+        with self._autocast():
+            if self.variational:
+                z_means, z_vars, latent_basal = self.encoder(x_)
+            else:
+                latent_basal = self.encoder(x_)
 
-        if self.loss_ae == 'nb':
-            library = self.l_encoder(x_)
-        else:
-            library = None
+            if self.loss_ae == 'nb':
+                library = self.l_encoder(x_)
+            else:
+                library = None
 
-        latent_treatment = self.drug_network(drugs, doses)
+            latent_treatment = self.drug_network(drugs, doses)
 
-        latent_cat_covariates = []
-        for covar, _ in self.cat_covars_encoder.items():
-            latent_covar_i = self.cat_covars_embeddings[covar](cat_covars_dict[covar].long())
-            latent_covar_i = latent_covar_i.view(batch_size, self.n_latent).unsqueeze(0)  # 1, batch_size, n_latent
-            latent_cat_covariates.append(latent_covar_i)
+        # Everything downstream of the MLPs is computed in fp32
+        latent_basal = latent_basal.float()
+        latent_treatment = latent_treatment.float()
+        if library is not None:
+            library = library.float()
 
-        latent_cont_covariates = []
-        for covar, _ in self.cont_covars:
-            latent_covar_i = self.cont_covars_embeddings[covar](cont_covars_dict[covar])
-            latent_covar_i = latent_covar_i.view(batch_size, self.n_latent).unsqueeze(0)  # 1, batch_size, n_latent
-            latent_cont_covariates.append(latent_covar_i)
+        if self.variational:
+            basal_distribution = db.Normal(z_means.float(), z_vars.float().sqrt())
+        else:
+            basal_distribution = None
 
+        # Out-of-place, latent_basal is still needed by the adversaries. Under `use_compile` the
+        # additions below are fused into a single kernel by inductor
         latent = latent_basal + latent_treatment
 
-        if len(latent_cat_covariates) > 0:
-            latent_cat_covariates = torch.cat(latent_cat_covariates, 0).sum(
-                0)  # Summing all categorical covariates representations
+        if cat_covars is not None:
+            # Summing all categorical covariates representations. Functional call, skipping the
+            # `nn.Module.__call__` overhead
+            latent_cat_covariates = F.embedding_bag(
+                cat_covars + self._cat_covars_offsets, self.cat_covars_embeddings.weight, mode='sum'
+            )
             latent += latent_cat_covariates
         else:
             latent_cat_covariates = None
 
-        if len(latent_cont_covariates) > 0:
-            latent_cont_covariates = torch.cat(latent_cont_covariates, 0).sum(
-                0)  # Summing all continuous covariates representations
+        if cont_covars is not None:
+            # Summing all continuous covariates representations, as a running sum so that no
+            # (n_cont_covars, batch_size, n_latent) intermediate is materialized
+            latent_cont_covariates = sum(
+                self.cont_covars_embeddings[covar](cont_covars[:, i:i + 1])
+                for i, covar in enumerate(self.cont_covars)
+            )
             latent += latent_cont_covariates
         else:
             latent_cont_covariates = None
@@ -323,6 +449,175 @@ class CPAModule(BaseModuleClass):
             latent_cat_covariates=latent_cat_covariates,
             library=library,
             basal_distribution=basal_distribution,
+            cat_covars=cat_covars,  # also the targets of the adversarial classifiers
+            cont_covars=cont_covars,  # also the targets of the adversarial regressors
+        )
+
+    @torch.no_grad()
+    def inference_graphed(
+            self,
+            genes,
+            drugs,
+            doses,
+            cat_covars,
+            cont_covars,
+    ):
+        """Runs `inference` by replaying a captured CUDA graph.
+
+        One graph is captured per batch size, so all kernels of the forward pass are submitted
+        with a single launch. A batch size is only captured the second time it is seen, so that
+        e.g. the partial last batch of a single pass over the data runs eagerly, and at most
+        `max_inference_graphs` graphs are kept (the oldest ones are evicted). Falls
+        back to the eager `inference` in training mode, for the variational encoder (the
+        distribution's argument validation syncs with the host, which is not allowed during
+        capture) or when the module is not on a CUDA device.
+
+        Inputs are copied into the static device buffers, asynchronously when they come from
+        pinned memory (e.g. a DataLoader with `pin_memory=True`).
+
+        Note that the returned tensors are static buffers which are overwritten by the next call
+        with the same batch size, clone them if they have to outlive it.
+        """
+        inputs = dict(
+            genes=genes,
+            drugs=drugs,
+            doses=doses,
+            cat_covars=cat_covars,
+            cont_covars=cont_covars,
+        )
+        if self.training or self.variational or self._cached_device.type != 'cuda' or self.use_compile:
+            return self.inference(**inputs)
+
+        batch_size = genes.shape[0]
+        if batch_size not in self._inference_graphs:
+            if batch_size not in self._inference_calls:
+                self._inference_calls.add(batch_size)
+                return self.inference(**inputs)
+            self._inference_calls.discard(batch_size)
+            if len(self._inference_graphs) >= self.max_inference_graphs:
+                del self._inference_graphs[next(iter(self._inference_graphs))]
+
+            static_inputs = _to_static(inputs, self._cached_device)
+
+            # Warmup on a side stream before capturing
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self.inference(**static_inputs)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_outputs = self.inference(**static_inputs)
+
+            self._inference_graphs[batch_size] = (graph, static_inputs, static_outputs)
+
+        graph, static_inputs, static_outputs = self._inference_graphs[batch_size]
+        _copy_static(static_inputs, inputs)
+        graph.replay()
+
+        return static_outputs
+
+    @torch.no_grad()
+    def optimize_for_inference(self):
+        """Folds all BatchNorm layers into their preceding Linear layers.
+
+        Meant to be called once on a trained (or loaded) module that is only used for inference
+        afterwards, since the running statistics are baked into the weights. Puts the module in
+        eval mode.
+        """
+        self.eval()
+        fold_batch_norm(self)
+        # Captured graphs still point to the replaced layers
+        self.reset_inference_graphs()
+        return self
+
+    def reset_inference_graphs(self):
+        """Drops all CUDA graphs captured by `inference_graphed`"""
+        self._inference_graphs = {}
+        self._inference_calls = set()
+
+    def _apply(self, fn, *args, **kwargs):
+        # `.to()`, `.cuda()`, `.half()`, ... replace the parameters the captured graphs point to
+        self.reset_inference_graphs()
+        module = super()._apply(fn, *args, **kwargs)
+        self._cached_device = next(self.parameters()).device
+        return module
+
+    def _get_export_input(self, tensors):
+        """Flat tuple of input tensors expected by the modules returned by `to_torchscript` and `to_tensorrt`"""
+        inputs = self._get_inference_input(tensors)
+        return tuple(inputs[key] for key in ['genes', 'drugs', 'cat_covars', 'cont_covars'] if inputs[key] is not None)
+
+    @torch.no_grad()
+    def to_torchscript(self, example_tensors):
+        """Traces `inference` -> `generative` into a frozen TorchScript module.
+
+        The traced graph is frozen and passed through `torch.jit.optimize_for_inference`, which
+        enables the oneDNN Linear+BatchNorm / Linear+ReLU fusions on CPU, so move the module to
+        the CPU beforehand for CPU deployment. Only implemented for the gaussian likelihood.
+
+        Parameters
+        ----------
+        example_tensors : dict
+            A batch of inputs, as produced by the data loaders
+
+        Returns
+        -------
+        A TorchScript module called with `self._get_export_input(tensors)` and returning the
+        gene expression means and variances.
+        """
+        return torch.jit.optimize_for_inference(self._trace(example_tensors))
+
+    def _trace(self, example_tensors):
+        """Frozen TorchScript trace of `_ExpressionModule`, shared by `to_torchscript` and `to_tensorrt`"""
+        assert self.loss_ae in ['gauss', 'mse']
+        self.eval()
+        traced = torch.jit.trace(
+            _ExpressionModule(self).eval(),
+            self._get_export_input(example_tensors),
+            strict=False,
+        )
+        return torch.jit.freeze(traced)
+
+    @torch.no_grad()
+    def to_tensorrt(self, example_tensors, precision: str = 'fp16'):
+        """Compiles `inference` -> `generative` into a TensorRT engine with Torch-TensorRT.
+
+        Requires the optional `torch_tensorrt` package (1.x) and the module on a CUDA device. The
+        frozen trace of `to_torchscript` is compiled with the TorchScript frontend, int64 covariate
+        indices are truncated to int32 for TensorRT. The engine is tuned to the exact shapes of
+        `example_tensors`. Only implemented for the gaussian likelihood.
+
+        Parameters
+        ----------
+        example_tensors : dict
+            A batch of inputs, as produced by the data loaders
+        precision : str
+            Either "fp16" or "fp32"
+
+        Returns
+        -------
+        A compiled module called with `self._get_export_input(tensors)` and returning the gene
+        expression means and variances.
+        """
+        try:
+            import torch_tensorrt
+        except ImportError:
+            raise ImportError('`to_tensorrt` requires torch-tensorrt, install it with `pip install torch-tensorrt`')
+
+        assert precision in ['fp16', 'fp32']
+        assert self._cached_device.type == 'cuda', '`to_tensorrt` requires the module on a CUDA device'
+
+        example_tensors = {key: val.to(self._cached_device) for key, val in example_tensors.items()}
+        example_inputs = self._get_export_input(example_tensors)
+        return torch_tensorrt.compile(
+            self._trace(example_tensors),
+            ir='ts',
+            inputs=[torch_tensorrt.Input(shape=tuple(t.shape), dtype=t.dtype) for t in example_inputs],
+            enabled_precisions={torch.float16} if precision == 'fp16' else {torch.float32},
+            truncate_long_and_double=True,
         )
 
     def _get_generative_input(self, tensors, inference_outputs, **kwargs):
@@ -331,11 +626,6 @@ class CPAModule(BaseModuleClass):
         latent = inference_outputs["latent"]
         latent_basal = inference_outputs['latent_basal']
 
-        covars_dict = dict()
-        for covar, _ in self.cat_covars_encoder.items():
-            val = tensors[covar].view(-1, )
-            covars_dict[covar] = val
-
         input_dict['latent'] = latent
         input_dict['latent_basal'] = latent_basal
         input_dict['library'] = inference_outputs['library']
@@ -347,9 +637,20 @@ class CPAModule(BaseModuleClass):
             latent,
             latent_basal,
             library=None,
+    ):
+        if self.use_compile:
+            return _compile(CPAModule._generative, self.compile_mode)(self, latent, latent_basal, library)
+        return self._generative(latent, latent_basal, library)
+
+    def _generative(
+            self,
+            latent,
+            latent_basal,
+            library=None,
     ):
         if self.loss_ae in ['mse', 'gauss']:
-            outputs = self.decoder(inputs=latent)
+            with self._autocast():
+                outputs = self.decoder(inputs=latent)
             return dict(
                 means=outputs.loc,
                 variances=outputs.variance,
@@ -357,12 +658,29 @@ class CPAModule(BaseModuleClass):
                 samples=outputs.sample_n(n=1).squeeze(0),
             )
         elif self.loss_ae == 'nb':
-            outputs = self.decoder(inputs=latent, library=library, px_r=self.px_r)
+            with self._autocast():
+                outputs = self.decoder(inputs=latent, library=library, theta=self._get_px_theta())
             return dict(
                 distribution=outputs,
                 samples=outputs.sample().squeeze(0),
             )
 
+    def _get_px_theta(self):
+        """Inverse dispersion of the NB decoder, i.e. `px_r.exp()`.
+
+        Outside of training (eval mode without gradients) it is computed once and reused until
+        `px_r` is modified in-place (e.g. by an optimizer step or `load_state_dict`) or replaced
+        (e.g. by `load_state_dict(..., assign=True)`).
+        """
+        if self.training or torch.is_grad_enabled():
+            return self.px_r.exp()
+        # A replaced parameter may have the same version counter as the cached one
+        px_theta_key = (self.px_r.data_ptr(), self.px_r._version)
+        if self._px_theta is None or self._px_theta_key != px_theta_key:
+            self._px_theta = self.px_r.detach().exp()
+            self._px_theta_key = px_theta_key
+        return self._px_theta
+
     def loss(self, tensors, inference_outputs, generative_outputs):
         """Computes the reconstruction loss (AE) or the ELBO (VAE)"""
         x = tensors[CPA_REGISTRY_KEYS.X_KEY]
@@ -370,7 +688,7 @@ class CPAModule(BaseModuleClass):
         if self.loss_ae in ["gauss", "mse"]:
             means = generative_outputs["means"]
             variances = generative_outputs["variances"]
-            reconstruction_loss = self.ae_loss_fn(x, means, variances)
+            reconstruction_loss = _gaussian_nll(x, means, variances)
         elif self.loss_ae == 'nb':
             dist_px = generative_outputs['distribution']
             log_px = dist_px.log_prob(x).mean(-1)
@@ -427,7 +745,7 @@ class CPAModule(BaseModuleClass):
                 pred_x['variances'] *= deg_mask
 
         if self.loss_ae in ['gauss', 'mse']:
-            reconstruction_loss = self.ae_loss_fn(x, pred_x['means'], pred_x['variances'])
+            reconstruction_loss = _gaussian_nll(x, pred_x['means'], pred_x['variances'])
 
         elif self.loss_ae == 'nb':
             dist_px = generative_outputs['distribution']
@@ -439,87 +757,61 @@ class CPAModule(BaseModuleClass):
 
         return reconstruction_loss
 
-    def adversarial_loss(self, tensors, latent_basal):
+    def adversarial_loss(self, tensors, inference_outputs):
         """Computes adversarial classification losses and regularizations"""
-        drugs_doses = tensors['drugs_doses']
-        batch_size = drugs_doses.shape[0]
-
-        drugs_pred = self.drugs_classifier(latent_basal)
-        cat_covars_pred = {}
-        for covar in self.cat_covars_encoder.keys():
-            if self.cat_covars_classifiers[covar] is not None:
-                covar_pred = self.cat_covars_classifiers[covar](latent_basal)
-                cat_covars_pred[covar] = covar_pred
-            else:
-                cat_covars_pred[covar] = None
-
-        cont_covars_pred = {}
-        for covar in self.cont_covars:
-            if self.cont_covars_regressors[covar] is not None:
-                covar_pred = self.cont_covars_regressors[covar](latent_basal)
-                cont_covars_pred[covar] = covar_pred
+        latent_basal = inference_outputs['latent_basal']
+        cat_covars = inference_outputs['cat_covars']
+        cont_covars = inference_outputs['cont_covars']
+        batch_size = latent_basal.shape[0]
+
+        with self._autocast():
+            drugs_pred = self.drugs_classifier(latent_basal).float()
+            if self.cat_covars_classifier is not None:
+                cat_covars_logits = self.cat_covars_classifier(latent_basal).float()
             else:
-                cont_covars_pred[covar] = None
+                cat_covars_logits = None
+            cont_covars_pred = [self.cont_covars_regressors[covar](latent_basal).float() for covar in self.cont_covars]
 
         adv_results = {}
 
-        # Classification losses for different categorical covariates
-        for covar in self.cat_covars_encoder.keys():
-            adv_results[f'adv_{covar}'] = self.adv_loss_cat_covariates(
-                cat_covars_pred[covar],
-                tensors[covar].view(-1, ).long(),
-            ) if cat_covars_pred[covar] is not None else torch.as_tensor(0.0).to(self.device)
-            adv_results[f'acc_{covar}'] = torch.sum(
-                cat_covars_pred[covar].argmax(1) == tensors[covar].long().view(-1, )) / batch_size \
-                if cat_covars_pred[covar] is not None else torch.as_tensor(0.0).to(self.device)
+        # Classification losses for different categorical covariates, the loops run over the
+        # covariate layout fixed in `__init__`
+        if cat_covars_logits is not None:
+            for covar, column, covar_pred in zip(self._cat_covars_adv_keys,
+                                                 self._cat_covars_adv_columns,
+                                                 cat_covars_logits.split(self._cat_covars_adv_sizes, dim=-1)):
+                covar_labels = cat_covars[:, column]
+                adv_results[f'adv_{covar}'] = self.adv_loss_cat_covariates(covar_pred, covar_labels)
+                adv_results[f'acc_{covar}'] = torch.sum(covar_pred.argmax(1) == covar_labels) / batch_size
+        for covar in self._cat_covars_no_adv_keys:
+            adv_results[f'adv_{covar}'] = self._zero
+            adv_results[f'acc_{covar}'] = self._zero
 
         # Regression losses for different continuous covariates
-        for covar in self.cont_covars:
-            adv_results[f'adv_{covar}'] = self.adv_loss_cont_covariates(
-                cont_covars_pred[covar],
-                tensors[covar].view(-1, ),
-            ) if cont_covars_pred[covar] is not None else torch.as_tensor(0.0).to(self.device)
-
-        # Classification loss for different drug combinations
-        adv_results['adv_drugs'] = self.adv_loss_drugs(drugs_pred, drugs_doses.gt(
-            0).float())
+        for i, (covar, covar_pred) in enumerate(zip(self.cont_covars, cont_covars_pred)):
+            adv_results[f'adv_{covar}'] = self.adv_loss_cont_covariates(covar_pred, cont_covars[:, i:i + 1])
+
+        # Classification loss for different drug combinations, the labels are only built here so
+        # that the inference pass does not compute them at prediction time
+        drugs_labels = tensors['drugs_doses'].gt(0).float()
+        adv_results['adv_drugs'] = self.adv_loss_drugs(drugs_pred, drugs_labels)
         adv_results['adv_loss'] = \
             adv_results['adv_drugs'] + \
-            sum([adv_results[f'adv_{key}'] for key in self.cat_covars_encoder.keys()]) + \
+            sum([adv_results[f'adv_{key}'] for key in self._cat_covars_keys]) + \
             sum([adv_results[f'adv_{key}'] for key in self.cont_covars])
 
-        # Penalty losses
-        for covar in self.cat_covars_encoder.keys():
-            adv_results[f'penalty_{covar}'] = (
-                torch.autograd.grad(
-                    cat_covars_pred[covar].sum(),
-                    latent_basal,
-                    create_graph=True
-                )[0].pow(2).mean()
-            ) if cat_covars_pred[covar] is not None else torch.as_tensor(0.0).to(self.device)
-
-        for covar in self.cont_covars:
-            adv_results[f'penalty_{covar}'] = (
-                torch.autograd.grad(
-                    cont_covars_pred[covar].sum(),
-                    latent_basal,
-                    create_graph=True
-                )[0].pow(2).mean()
-            ) if cont_covars_pred[covar] is not None else torch.as_tensor(0.0).to(self.device)
-
-        adv_results['penalty_drugs'] = (
+        # Penalty loss, computed with a single backward pass over all adversaries
+        adv_preds = [drugs_pred] + \
+                    ([cat_covars_logits] if cat_covars_logits is not None else []) + \
+                    cont_covars_pred
+        adv_results['penalty_adv'] = (
             torch.autograd.grad(
-                drugs_pred.sum(),
+                torch.cat(adv_preds, dim=1).sum(),
                 latent_basal,
                 create_graph=True,
             )[0].pow(2).mean()
         )
 
-        adv_results['penalty_adv'] = \
-            adv_results['penalty_drugs'] + \
-            sum([adv_results[f'penalty_{covar}'] for covar in self.cat_covars_encoder.keys()]) + \
-            sum([adv_results[f'penalty_{covar}'] for covar in self.cont_covars])
-
         return adv_results
 
     def r2_metric(self, tensors, inference_outputs, generative_outputs, method: str = 'lfc'):
@@ -834,3 +1126,54 @@ class CPAModule(BaseModuleClass):
         doses = None
 
         return self.drug_network(drugs, doses)
+
+    def get_covar_embeddings(self, covariate, covar_ids):
+        """Looks up the embeddings of `covar_ids` for the categorical `covariate`"""
+        offset = self._cat_covars_offsets[self._cat_covars_keys.index(covariate)]
+        return self.cat_covars_embeddings.weight[covar_ids + offset]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved with one `nn.Embedding` per categorical covariate: their tables are
+        # stacked in the covariates order, matching `_cat_covars_offsets`
+        old_keys = [f'{prefix}cat_covars_embeddings.{covar}.weight' for covar in self._cat_covars_keys]
+        if len(old_keys) > 0 and all(key in state_dict for key in old_keys):
+            state_dict[f'{prefix}cat_covars_embeddings.weight'] = torch.cat(
+                [state_dict.pop(key) for key in old_keys], dim=0
+            )
+        # The per-covariate adversaries do not map onto the grouped `cat_covars_classifier`. They
+        # are only used for training, so they are dropped and the grouped one keeps its initial weights
+        old_keys = [key for key in state_dict if key.startswith(f'{prefix}cat_covars_classifiers.')]
+        if len(old_keys) > 0:
+            logger.warning(
+                'Dropping the per-covariate adversarial classifiers (`cat_covars_classifiers`) of this '
+                'checkpoint, the grouped `cat_covars_classifier` is freshly initialized. Inference is '
+                'unaffected, but the adversaries have to be retrained before further training.'
+            )
+            for key in old_keys:
+                state_dict.pop(key)
+            if self.cat_covars_classifier is not None:
+                for key, val in self.cat_covars_classifier.state_dict().items():
+                    state_dict.setdefault(f'{prefix}cat_covars_classifier.{key}', val)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class _ExpressionModule(nn.Module):
+    """Tensor-only `inference` -> `generative` path of a `CPAModule`, used for tracing"""
+
+    def __init__(self, module: CPAModule):
+        super().__init__()
+        self.module = module
+
+    def forward(self, genes, drugs, *covars):
+        covars = list(covars)
+        cat_covars = covars.pop(0) if len(self.module._cat_covars_keys) > 0 else None
+        cont_covars = covars.pop(0) if len(self.module.cont_covars) > 0 else None
+
+        # The eager passes, the traced graph must not contain `torch.compile`d functions
+        inference_outputs = self.module._inference(genes, drugs, None, cat_covars, cont_covars)
+        generative_outputs = self.module._generative(
+            inference_outputs['latent'],
+            inference_outputs['latent_basal'],
+            library=inference_outputs['library'],
+        )
+        return generative_outputs['means'], generative_outputs['variances']
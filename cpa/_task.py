@@ -90,7 +90,6 @@ class CPATrainingPlan(TrainingPlan):
             'cycle_loss': [],
             'penalty_adv': [],
             'adv_drugs': [],
-            'penalty_drugs': [],
             'reg_mean': [],
             'reg_var': [],
             'disent_basal': [],
@@ -99,7 +98,6 @@ class CPATrainingPlan(TrainingPlan):
 
         for covar in self.covars_encoder.keys():
             self.epoch_history[f'adv_{covar}'] = []
-            self.epoch_history[f'penalty_{covar}'] = []
 
     def configure_optimizers(self):
         if hasattr(self.module.drug_network, 'drug_encoder'):
@@ -135,7 +133,8 @@ class CPATrainingPlan(TrainingPlan):
 
         optimizer_adversaries = torch.optim.Adam(
             list(filter(lambda p: p.requires_grad, self.module.drugs_classifier.parameters())) +
-            list(filter(lambda p: p.requires_grad, self.module.cat_covars_classifiers.parameters())) +
+            (list(filter(lambda p: p.requires_grad, self.module.cat_covars_classifier.parameters()))
+             if self.module.cat_covars_classifier is not None else []) +
             list(filter(lambda p: p.requires_grad, self.module.cont_covars_regressors.parameters())),
             lr=self.adversary_lr,
             weight_decay=self.adversary_wd)
@@ -164,8 +163,7 @@ class CPATrainingPlan(TrainingPlan):
             # Adversarial update
             if self.iter_count % self.adversary_steps != 0:
                 opt_adv.zero_grad()
-                latent_basal = inf_outputs['latent_basal']
-                adv_results = self.module.adversarial_loss(tensors=batch, latent_basal=latent_basal)
+                adv_results = self.module.adversarial_loss(tensors=batch, inference_outputs=inf_outputs)
                 self.manual_backward(adv_results['adv_loss'] + self.penalty_adversary * adv_results['penalty_adv'])
                 opt_adv.step()
 
@@ -185,8 +183,7 @@ class CPATrainingPlan(TrainingPlan):
                     inference_outputs=inf_outputs,
                     generative_outputs=gen_outputs,
                 )
-                latent_basal = inf_outputs['latent_basal']
-                adv_results = self.module.adversarial_loss(tensors=batch, latent_basal=latent_basal)
+                adv_results = self.module.adversarial_loss(tensors=batch, inference_outputs=inf_outputs)
 
                 reconstruction_loss = reconstruction_loss.mean()
 
@@ -216,11 +213,9 @@ class CPATrainingPlan(TrainingPlan):
                 results.update({'recon_loss': reconstruction_loss.item()})
 
         else:
-            adv_results = {'adv_loss': 0.0, 'cycle_loss': 0.0, 'adv_drugs': 0.0, 'penalty_adv': 0.0,
-                           'penalty_drugs': 0.0}
+            adv_results = {'adv_loss': 0.0, 'cycle_loss': 0.0, 'adv_drugs': 0.0, 'penalty_adv': 0.0}
             for covar in self.covars_encoder.keys():
                 adv_results[f'adv_{covar}'] = 0.0
-                adv_results[f'penalty_{covar}'] = 0.0
 
             results = adv_results.copy()
 
@@ -249,15 +244,14 @@ class CPATrainingPlan(TrainingPlan):
         return results
 
     def training_epoch_end(self, outputs):
-        keys = ['recon_loss', 'cycle_loss', 'adv_loss', 'penalty_adv', 'adv_drugs', 'penalty_drugs', 'reg_mean',
+        keys = ['recon_loss', 'cycle_loss', 'adv_loss', 'penalty_adv', 'adv_drugs', 'reg_mean',
                 'reg_var', 'disent_basal', 'disent_after']
         for key in keys:
             self.epoch_history[key].append(np.mean([output[key] for output in outputs]))
 
         for covar in self.covars_encoder.keys():
-            key1, key2 = f'adv_{covar}', f'penalty_{covar}'
-            self.epoch_history[key1].append(np.mean([output[key1] for output in outputs]))
-            self.epoch_history[key2].append(np.mean([output[key2] for output in outputs]))
+            key = f'adv_{covar}'
+            self.epoch_history[key].append(np.mean([output[key] for output in outputs]))
 
         self.epoch_history['epoch'].append(self.current_epoch)
         self.epoch_history['mode'].append('train')
@@ -297,10 +291,9 @@ class CPATrainingPlan(TrainingPlan):
             generative_outputs=gen_outputs,
         )
 
-        adv_results = {'adv_loss': 0.0, 'cycle_loss': 0.0, 'adv_drugs': 0.0, 'penalty_adv': 0.0, 'penalty_drugs': 0.0}
+        adv_results = {'adv_loss': 0.0, 'cycle_loss': 0.0, 'adv_drugs': 0.0, 'penalty_adv': 0.0}
         for covar in self.covars_encoder.keys():
             adv_results[f'adv_{covar}'] = 0.0
-            adv_results[f'penalty_{covar}'] = 0.0
 
         r2_mean, r2_var = self.module.r2_metric(batch, inf_outputs, gen_outputs, method=self.r2_method)
         disent_basal, disent_after = self.module.disentanglement(batch, inf_outputs, gen_outputs)
@@ -317,15 +310,14 @@ class CPATrainingPlan(TrainingPlan):
         return results
 
     def validation_epoch_end(self, outputs):
-        keys = ['recon_loss', 'cycle_loss', 'adv_loss', 'penalty_adv', 'adv_drugs', 'penalty_drugs', 'reg_mean',
+        keys = ['recon_loss', 'cycle_loss', 'adv_loss', 'penalty_adv', 'adv_drugs', 'reg_mean',
                 'reg_var', 'disent_basal', 'disent_after']
         for key in keys:
             self.epoch_history[key].append(np.mean([output[key] for output in outputs]))
 
         for covar in self.covars_encoder.keys():
-            key1, key2 = f'adv_{covar}', f'penalty_{covar}'
-            self.epoch_history[key1].append(np.mean([output[key1] for output in outputs]))
-            self.epoch_history[key2].append(np.mean([output[key2] for output in outputs]))
+            key = f'adv_{covar}'
+            self.epoch_history[key].append(np.mean([output[key] for output in outputs]))
 
         self.epoch_history['epoch'].append(self.current_epoch)
         self.epoch_history['mode'].append('valid')
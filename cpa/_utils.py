@@ -7,6 +7,7 @@ from scvi.distributions import NegativeBinomial
 
 from scvi.nn import FCLayers
 from torch.distributions import Normal
+from torch.nn.utils.fusion import fuse_linear_bn_eval
 
 
 class _REGISTRY_KEYS:
@@ -22,6 +23,22 @@ class _REGISTRY_KEYS:
 CPA_REGISTRY_KEYS = _REGISTRY_KEYS()
 
 
+def fold_batch_norm(module: nn.Module) -> nn.Module:
+    """
+    Folds every BatchNorm1d of `module` into the Linear layer directly preceding it within the same
+    `nn.Sequential` (as in scvi's `FCLayers`). The BatchNorm layers are replaced by `nn.Identity`.
+    Only valid for modules in eval mode.
+    """
+    for child in list(module.modules()):
+        if isinstance(child, nn.Sequential):
+            layers = list(child.named_children())
+            for (name, layer), (next_name, next_layer) in zip(layers[:-1], layers[1:]):
+                if isinstance(layer, nn.Linear) and isinstance(next_layer, nn.BatchNorm1d):
+                    setattr(child, name, fuse_linear_bn_eval(layer, next_layer))
+                    setattr(child, next_name, nn.Identity())
+    return module
+
+
 class VanillaEncoder(nn.Module):
     def __init__(
             self,
@@ -91,8 +108,9 @@ class DecoderNormal(nn.Module):
 
     def forward(self, inputs, *cat_list):
         x = self.network(inputs, *cat_list)
-        locs = self.mean(x)
-        var_ = self.var(x)
+        # Output heads are kept in fp32 when running under autocast
+        locs = self.mean(x).float()
+        var_ = self.var(x).float()
         if self.output_activation == 'relu':
             locs = F.relu(locs)
         elif self.output_activation == 'leaky_relu':
@@ -129,10 +147,11 @@ class DecoderNB(nn.Module):
             nn.Softmax(-1),
         )
 
-    def forward(self, inputs, library, px_r):
+    def forward(self, inputs, library, theta):
+        """theta is the (already exponentiated) inverse dispersion"""
         px_scale = self.hidden(inputs)
         px_rate = library.exp() * px_scale
-        return NegativeBinomial(mu=px_rate, theta=px_r.exp())
+        return NegativeBinomial(mu=px_rate, theta=theta)
 
 
 class GeneralizedSigmoid(nn.Module):
@@ -246,7 +265,7 @@ class DrugNetwork(nn.Module):
                 drugs = drugs.long().view(-1, )
                 doses = doses.float().view(-1, )
                 scaled_dosages = self.dosers(doses, drugs)
-                drug_embeddings = self.drug_embedding(drugs)
+                drug_embeddings = F.embedding(drugs, self.drug_embedding.weight)
                 return torch.einsum('b,be->be', [scaled_dosages, drug_embeddings])
             else:
                 return self.dosers(drugs) @ self.drug_embedding.weight
@@ -0,0 +1,341 @@
+import io
+from copy import deepcopy
+
+import numpy as np
+import pytest
+import torch
+
+from cpa._data import collate_cat_covars
+from cpa._module import CPAModule, _gaussian_nll
+
+
+def generate_module(**kwargs):
+    torch.manual_seed(0)
+    module = CPAModule(
+        n_genes=20,
+        n_drugs=3,
+        cat_covars_encoder=dict(covar_1=['v1', 'v2'], covar_2=['a', 'b', 'c']),
+        n_latent=8,
+        autoencoder_width=16,
+        autoencoder_depth=2,
+        adversary_width=8,
+        dosers_width=8,
+        **kwargs,
+    )
+    return module
+
+
+def generate_batch(batch_size=16):
+    return dict(
+        X=torch.randn(batch_size, 20),
+        drugs_doses=torch.rand(batch_size, 3),
+        covar_1=torch.randint(2, size=(batch_size,)),
+        covar_2=torch.randint(3, size=(batch_size,)),
+    )
+
+
+def test_inference_graphed_cpu():
+    module = generate_module().eval()
+    batch = generate_batch()
+    inputs = module._get_inference_input(batch)
+
+    outputs = module.inference_graphed(**inputs)
+    expected = module.inference(**inputs)
+    assert torch.allclose(outputs['latent'], expected['latent'])
+    assert len(module._inference_graphs) == 0
+
+    module._inference_calls.add(16)
+    module.to('cpu')
+    assert len(module._inference_calls) == 0
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA graphs require a CUDA device')
+def test_inference_graphed_cuda():
+    module = generate_module().cuda().eval()
+
+    def check_replay(batch_size):
+        inputs = module._get_inference_input(generate_batch(batch_size))
+        with torch.no_grad():
+            outputs = module.inference_graphed(**inputs)
+            expected = module.inference(**inputs)
+        for key in ['latent', 'latent_basal', 'latent_treatment', 'latent_cat_covariates']:
+            assert torch.allclose(outputs[key], expected[key], atol=1e-5)
+
+    # Captured on the second call, replayed with new inputs afterwards
+    for _ in range(3):
+        check_replay(16)
+    assert list(module._inference_graphs) == [16]
+
+    # A one-off partial batch runs eagerly
+    check_replay(7)
+    assert 7 not in module._inference_graphs
+
+    # The oldest graphs are evicted
+    sizes = list(range(8, 8 + module.max_inference_graphs))
+    for batch_size in sizes:
+        check_replay(batch_size)
+        check_replay(batch_size)
+    assert list(module._inference_graphs) == sizes
+    check_replay(16)
+    check_replay(16)
+    assert list(module._inference_graphs) == sizes[1:] + [16]
+
+    # Moving the module or folding its BatchNorm layers drops the captured graphs
+    module.to('cuda')
+    assert len(module._inference_graphs) == 0
+    for _ in range(3):
+        check_replay(16)
+
+    module.optimize_for_inference()
+    assert len(module._inference_graphs) == 0
+    for _ in range(3):
+        check_replay(16)
+    assert list(module._inference_graphs) == [16]
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='torch.compile is only used on CUDA')
+def test_use_compile():
+    module = generate_module(use_compile=True).cuda().eval()
+    assert module.use_compile
+    batch = {key: val.cuda() for key, val in generate_batch().items()}
+    inputs = module._get_inference_input(batch)
+
+    with torch.no_grad():
+        inference_outputs = module.inference(**inputs)
+        latent = inference_outputs['latent'].clone()
+        means = module.generative(latent, inference_outputs['latent_basal'])['means'].clone()
+
+        expected_outputs = module._inference(**inputs)
+        expected_means = module._generative(expected_outputs['latent'], expected_outputs['latent_basal'])['means']
+    assert torch.allclose(latent, expected_outputs['latent'], atol=1e-4)
+    assert torch.allclose(means, expected_means, atol=1e-4)
+
+    # Copies run on their own weights, and the module can still be pickled
+    module_copy = deepcopy(module)
+    torch.nn.init.zeros_(module_copy.cat_covars_embeddings.weight)
+    with torch.no_grad():
+        copy_latent = module_copy.inference(**inputs)['latent_cat_covariates'].clone()
+        latent = module.inference(**inputs)['latent_cat_covariates'].clone()
+    assert torch.equal(copy_latent, torch.zeros_like(copy_latent))
+    assert torch.allclose(latent, expected_outputs['latent_cat_covariates'], atol=1e-4)
+    torch.save(module, io.BytesIO())
+
+
+def test_cat_covars_embeddings():
+    module = generate_module().eval()
+    batch = generate_batch()
+    inputs = module._get_inference_input(batch)
+
+    latent_cat_covariates = module.inference(**inputs)['latent_cat_covariates']
+    expected = module.get_covar_embeddings('covar_1', batch['covar_1']) + \
+        module.get_covar_embeddings('covar_2', batch['covar_2'])
+    assert torch.allclose(latent_cat_covariates, expected)
+
+    weight = module.cat_covars_embeddings.weight
+    assert torch.equal(module.get_covar_embeddings('covar_2', torch.arange(3)), weight[2:])
+
+
+def test_load_per_covariate_embeddings():
+    module = generate_module()
+    state_dict = module.state_dict()
+    weight = state_dict.pop('cat_covars_embeddings.weight')
+    state_dict['cat_covars_embeddings.covar_1.weight'] = weight[:2]
+    state_dict['cat_covars_embeddings.covar_2.weight'] = weight[2:]
+
+    new_module = generate_module()
+    torch.nn.init.zeros_(new_module.cat_covars_embeddings.weight)
+    new_module.load_state_dict(state_dict)
+    assert torch.equal(new_module.cat_covars_embeddings.weight, weight)
+
+
+def test_load_per_covariate_classifiers():
+    module = generate_module().eval()
+    batch = generate_batch()
+    with torch.no_grad():
+        means, variances = module.get_expression(batch)
+
+    # Checkpoint layout from before the shared embedding table and the grouped adversary
+    state_dict = module.state_dict()
+    weight = state_dict.pop('cat_covars_embeddings.weight')
+    state_dict['cat_covars_embeddings.covar_1.weight'] = weight[:2]
+    state_dict['cat_covars_embeddings.covar_2.weight'] = weight[2:]
+    for key in list(state_dict.keys()):
+        if key.startswith('cat_covars_classifier.'):
+            value = state_dict.pop(key)
+            for covar in ['covar_1', 'covar_2']:
+                state_dict[key.replace('cat_covars_classifier.', f'cat_covars_classifiers.{covar}.')] = value
+
+    new_module = generate_module(seed=1)
+    new_module.load_state_dict(state_dict)
+    new_module.eval()
+    assert not any(key.startswith('cat_covars_classifiers.') for key in new_module.state_dict())
+    with torch.no_grad():
+        loaded_means, loaded_variances = new_module.get_expression(batch)
+    assert torch.allclose(loaded_means, means)
+    assert torch.allclose(loaded_variances, variances)
+
+
+def test_gaussian_nll():
+    x = torch.randn(16, 20)
+    means = torch.randn(16, 20)
+    variances = torch.rand(16, 20)
+    variances[0, 0] = 0.
+    variances.requires_grad_(True)
+
+    loss = _gaussian_nll(x, means, variances)
+    expected = torch.nn.GaussianNLLLoss()(means, x, variances)
+    assert torch.allclose(loss, expected)
+
+    grad, = torch.autograd.grad(loss, variances)
+    expected_grad, = torch.autograd.grad(expected, variances)
+    assert torch.allclose(grad, expected_grad)
+
+    with pytest.raises(ValueError, match='negative'):
+        _gaussian_nll(x, means, -variances.detach())
+
+
+def test_autocast_cpu():
+    module = generate_module(use_amp=True)
+    assert module._cached_device.type == 'cpu'
+    with module._autocast():
+        assert not torch.is_autocast_enabled()
+
+
+def test_optimize_for_inference():
+    module = generate_module()
+    batch = generate_batch()
+    inputs = module._get_inference_input(batch)
+    with torch.no_grad():
+        # Moves the BatchNorm running statistics away from their initial values
+        for _ in range(3):
+            module.inference(**inputs)
+
+        module.eval()
+        latent = module.inference(**inputs)['latent']
+        means, variances = module.get_expression(batch)
+
+        module.optimize_for_inference()
+        assert not any(isinstance(layer, torch.nn.BatchNorm1d) for layer in module.modules())
+        assert torch.allclose(module.inference(**inputs)['latent'], latent, atol=1e-5)
+        optimized_means, optimized_variances = module.get_expression(batch)
+        assert torch.allclose(optimized_means, means, atol=1e-5)
+        assert torch.allclose(optimized_variances, variances, atol=1e-5)
+
+
+def test_to_torchscript():
+    module = generate_module().eval()
+    batch = generate_batch()
+
+    scripted = module.to_torchscript(batch)
+    with torch.no_grad():
+        means, variances = module.get_expression(batch)
+        scripted_means, scripted_variances = scripted(*module._get_export_input(batch))
+    assert torch.allclose(scripted_means, means, atol=1e-5)
+    assert torch.allclose(scripted_variances, variances, atol=1e-5)
+
+
+def test_px_theta_cache():
+    module = generate_module(loss_ae='nb').eval()
+    with torch.no_grad():
+        px_theta = module._get_px_theta()
+        assert module._get_px_theta() is px_theta
+
+        module.px_r.add_(1.)
+        assert torch.allclose(module._get_px_theta(), module.px_r.exp())
+
+        # A replacing parameter (e.g. from `load_state_dict(..., assign=True)`) with the same
+        # version counter as the cached one
+        assert module._get_px_theta() is module._get_px_theta()
+        px_r = torch.nn.Parameter(torch.randn(20))
+        while px_r._version < module.px_r._version:
+            px_r.add_(0.)
+        assert px_r._version == module.px_r._version
+        module.px_r = px_r
+        assert torch.allclose(module._get_px_theta(), px_r.exp())
+
+    module.train()
+    assert module._get_px_theta().requires_grad
+
+
+def test_adversarial_loss():
+    module = generate_module()
+    batch = generate_batch()
+    inference_outputs = module.inference(**module._get_inference_input(batch))
+    assert 'drugs_labels' not in inference_outputs
+
+    adv_results = module.adversarial_loss(batch, inference_outputs)
+    expected = torch.nn.BCEWithLogitsLoss()(
+        module.drugs_classifier(inference_outputs['latent_basal']), batch['drugs_doses'].gt(0).float()
+    )
+    assert torch.allclose(adv_results['adv_drugs'], expected)
+    assert adv_results['penalty_adv'].requires_grad
+
+
+def test_collate_cat_covars():
+    batch = dict(
+        X=np.random.randn(16, 20).astype(np.float32),
+        covar_1=np.random.randint(2, size=(16, 1)).astype(np.float32),
+    )
+    collated = collate_cat_covars(batch, cat_covars_keys=['covar_1'])
+    assert collated['X'].dtype == torch.float32
+    assert collated['covar_1'].dtype == torch.long
+    assert collated['covar_1'].shape == (16,)
+    assert torch.equal(collated['covar_1'], torch.from_numpy(batch['covar_1']).long().view(-1, ))
+    assert torch.equal(collated['cat_covars'], collated['covar_1'].view(-1, 1))
+    assert 'cont_covars' not in collated
+
+    # Covariates stacked by the collate are used as they are
+    module = generate_module(cont_covars=['c0'])
+    batch = {key: val.numpy() for key, val in generate_batch().items()}
+    batch['c0'] = np.random.randn(16, 1).astype(np.float32)
+    collated = collate_cat_covars(batch, cat_covars_keys=['covar_1', 'covar_2'], cont_covars_keys=['c0'])
+    assert collated['cont_covars'].shape == (16, 1)
+    inference_inputs = module._get_inference_input(collated)
+    assert inference_inputs['cat_covars'] is collated['cat_covars']
+    assert inference_inputs['cont_covars'] is collated['cont_covars']
+    assert torch.equal(inference_inputs['cat_covars'],
+                       torch.stack([collated['covar_1'], collated['covar_2']], dim=1))
+
+    # The module accepts uncollated (float, (batch_size, 1)) covariates as well
+    module = generate_module()
+    uncollated = generate_batch()
+    collated = dict(uncollated)
+    uncollated['covar_1'] = uncollated['covar_1'].float().view(-1, 1)
+    assert torch.equal(module._get_inference_input(uncollated)['cat_covars'],
+                       module._get_inference_input(collated)['cat_covars'])
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='TensorRT requires a CUDA device')
+def test_to_tensorrt():
+    pytest.importorskip('torch_tensorrt')
+    module = generate_module().cuda().eval()
+    batch = {key: val.cuda() for key, val in generate_batch().items()}
+
+    engine = module.to_tensorrt(batch, precision='fp32')
+    with torch.no_grad():
+        means, variances = module.get_expression(batch)
+        engine_means, engine_variances = engine(*module._get_export_input(batch))
+    assert torch.allclose(engine_means, means, atol=1e-3)
+    assert torch.allclose(engine_variances, variances, atol=1e-3)
+
+
+def test_cont_covars():
+    module = generate_module(cont_covars=['c0', 'c1'])
+    batch = generate_batch()
+    batch['c0'] = torch.randn(16, 1)
+    batch['c1'] = torch.randn(16, 1)
+    inference_outputs = module.inference(**module._get_inference_input(batch))
+
+    expected = module.cont_covars_embeddings['c0'](batch['c0']) + module.cont_covars_embeddings['c1'](batch['c1'])
+    assert torch.allclose(inference_outputs['latent_cont_covariates'], expected)
+    assert torch.allclose(
+        inference_outputs['latent'],
+        inference_outputs['latent_basal'] + inference_outputs['latent_treatment'] +
+        inference_outputs['latent_cat_covariates'] + expected,
+    )
+
+    adv_results = module.adversarial_loss(batch, inference_outputs)
+    for covar in ['c0', 'c1']:
+        covar_pred = module.cont_covars_regressors[covar](inference_outputs['latent_basal'])
+        expected_loss = torch.nn.functional.mse_loss(covar_pred, batch[covar])
+        assert torch.allclose(adv_results[f'adv_{covar}'], expected_loss)